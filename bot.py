@@ -2,20 +2,27 @@
 """
 SLC Trench Scanner helper (compact, single-file)
 - Hardcoded WALLET (your provided address)
-- Polls Solscan every 30s for last 50 txs
+- Polls Solana RPC every 30s for the last 50 signatures; details for new ones come from Solscan
 - Incoming >=0.15 SOL with memo "SLC30" grants access
 - Users map their wallet by DMing: /start <SOL_WALLET>
-- Stores users in slc_users.json (no DB)
+- Stores users in slc_users.json (no DB; compact machine-only JSON, flushed atomically every few seconds)
 - Daily midnight sweep: expire users after 30 days unless re-paid
 - Whitelist prevents kicking
 - /myjoin returns join and expiry
 - Uses env var SLC_DATA_FILE (e.g., /data/slc_users.json) for persistent storage
 """
-import requests, time, json, os, threading
+import requests, time, orjson, os, signal, sys, threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from itertools import accumulate, repeat
 
 # -------- CONFIG --------
 WALLET = "GFxQeqQBhgu4yLYLf7BFUBkRkhbfTnkAfwsrN9TEaTZv"
+WALLET_LC = WALLET.lower()
 
 # Prefer environment variables; fall back to literals if you want to hardcode.
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "") or ""
@@ -35,121 +42,242 @@ if DATA_FILE != legacy and os.path.exists(legacy) and not os.path.exists(DATA_FI
 # ------------------------
 
 SOLSCAN_BASE = "https://public-api.solscan.io"
+SOLANA_RPC = os.getenv("SOLANA_RPC_URL", "") or "https://api.mainnet-beta.solana.com"
 TELE_BASE = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
 MIN_LAMPORTS = int(0.15 * 1_000_000_000)
+TRANSFER_KEYS = ("nativeTransfers","solTransfers","transfers","tokenTransfers","sol_transfer")
+DETAIL_WORKERS = 8   # concurrent Solscan tx-detail fetches per poll
+DETAIL_MAX_ATTEMPTS = 20  # failed detail fetches (~10 min of polls) before a signature is marked seen
+KICK_WORKERS = 16    # concurrent kick+notify pairs during the expiry sweep
+TG_LONG_POLL = 50    # getUpdates server-side wait (seconds); client timeout must exceed it
+SEEN_TX_MAX = 5000   # cap on remembered tx signatures (oldest evicted first)
+FLUSH_INTERVAL = 5   # seconds between checks for unsaved changes
+EXPIRY_RECHECK = 300 # max seconds between clock checks while waiting for the midnight sweep
 
 WHITELIST = ["leopex1","Degenetive","SLCScannerBot","Steez431","cripplingdegen","ARC","MoneyMalicia"]
-WL_SET = set(u.lower().lstrip("@") for u in WHITELIST)
+WL_SET = frozenset(sys.intern(u.lower().lstrip("@")) for u in WHITELIST)
+
+# One pooled keep-alive session for every Telegram/Solscan call. Retries cover connection
+# errors and 429/5xx (honouring Retry-After); POSTs are not retried on status to avoid
+# duplicate sends.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                       max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]))
+SESSION.mount("https://api.telegram.org/", _adapter)
+SESSION.mount(SOLSCAN_BASE + "/", _adapter)
+SESSION.mount(SOLANA_RPC, _adapter)
 
 def load_data():
-    if os.path.exists(DATA_FILE):
-        return json.load(open(DATA_FILE))
-    return {"users": {}, "wallet_map": {}, "seen_tx": []}
+    try:
+        with open(DATA_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {"users": {}, "wallet_map": {}, "user_wallets": {}, "seen_tx": []}
+
+class RWLock:
+    """Many concurrent readers or one writer; a waiting writer blocks new readers. Not reentrant."""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+# `data` is shared by every background thread; read it under data_lock.read(), mutate it under
+# data_lock.write() and set `dirty` instead of writing the file. flush_loop persists it; save_lock
+# serializes file writers.
+data_lock = RWLock()
+save_lock = threading.Lock()
+dirty = threading.Event()
 
 def save_data(d):
-    json.dump(d, open(DATA_FILE, "w"), indent=2)
+    with save_lock:
+        with data_lock.write():
+            d["seen_tx"] = list(seen_dq)
+            payload = orjson.dumps(d)
+        tmp = DATA_FILE + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, DATA_FILE)
+
+def flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        if dirty.is_set():
+            dirty.clear()
+            try:
+                save_data(data)
+            except Exception as e:
+                print("save error", e)
+                dirty.set()
 
 def send_message(chat_id, text):
     try:
-        requests.post(f"{TELE_BASE}/sendMessage", json={"chat_id": chat_id, "text": text}, timeout=10)
+        SESSION.post(f"{TELE_BASE}/sendMessage", json={"chat_id": chat_id, "text": text}, timeout=10)
     except Exception:
         pass
 
 def export_invite_link(chat_id):
     try:
-        r = requests.post(f"{TELE_BASE}/exportChatInviteLink", json={"chat_id": chat_id}, timeout=10).json()
+        r = orjson.loads(SESSION.post(f"{TELE_BASE}/exportChatInviteLink", json={"chat_id": chat_id}, timeout=10).content)
         return r.get("result")
     except Exception:
         return None
 
 def kick_from_chat(chat_id, user_id):
-    try:
-        requests.post(f"{TELE_BASE}/kickChatMember", json={"chat_id": chat_id, "user_id": user_id}, timeout=10)
-    except Exception:
-        pass
+    """True once Telegram confirms the kick. A 429 is retried after its retry_after (3 tries max)."""
+    for _ in range(3):
+        try:
+            r = SESSION.post(f"{TELE_BASE}/kickChatMember", json={"chat_id": chat_id, "user_id": user_id}, timeout=10)
+            body = orjson.loads(r.content)
+        except Exception:
+            return False
+        if r.ok and body.get("result"):
+            return True
+        retry_after = (body.get("parameters") or {}).get("retry_after")
+        if r.status_code != 429 or not retry_after:
+            return False
+        time.sleep(retry_after)
+    return False
 
-def get_last_txs_for(address, limit=50):
+def get_recent_signatures(address, limit=50):
+    """Newest-first signatures of successful txs for address via getSignaturesForAddress
+    (sig-only, much lighter than Solscan's tx list). Failed txs (err set) are dropped."""
     try:
-        r = requests.get(f"{SOLSCAN_BASE}/account/transactions?account={address}&limit={limit}", timeout=10)
-        return r.json() if r.status_code == 200 else []
+        body = {"jsonrpc": "2.0", "id": 1, "method": "getSignaturesForAddress", "params": [address, {"limit": limit}]}
+        r = SESSION.post(SOLANA_RPC, json=body, timeout=10)
+        if r.status_code != 200:
+            return []
+        return [e["signature"] for e in orjson.loads(r.content).get("result") or [] if e.get("err") is None]
     except Exception:
         return []
 
 def get_tx_detail(signature):
+    """Returns (parsed_json, raw_body); raw_body lets callers substring-scan without re-serializing."""
     try:
-        r = requests.get(f"{SOLSCAN_BASE}/transaction/{signature}", timeout=10)
-        return r.json() if r.status_code == 200 else {}
+        r = SESSION.get(f"{SOLSCAN_BASE}/transaction/{signature}", timeout=10)
+        return (orjson.loads(r.content), r.content) if r.status_code == 200 else ({}, b"")
     except Exception:
-        return {}
+        return {}, b""
 
 data = load_data()
+# user_wallets is the inverse of wallet_map (uname -> [wallets]); rebuild it for older data files.
+if "user_wallets" not in data:
+    data["user_wallets"] = {}
+    for w, a in data.get("wallet_map", {}).items():
+        data["user_wallets"].setdefault(a, []).append(w)
+# seen_set gives O(1) lookups; seen_dq keeps insertion order and bounds memory/file size.
+seen_dq = deque(data.get("seen_tx", []), maxlen=SEEN_TX_MAX)
+seen_set = set(seen_dq)
+
+def remember_tx(sig):
+    if len(seen_dq) == seen_dq.maxlen:
+        seen_set.discard(seen_dq[0])
+    seen_dq.append(sig)
+    seen_set.add(sig)
 
 def norm_username(u):
     if not u: return ""
-    return u.lower().lstrip("@")
+    return sys.intern(u.lower().lstrip("@"))
 
 def is_whitelisted(username):
     return norm_username(username) in WL_SET
 
-def handle_new_payment(tx):
-    sig = tx.get("txHash") or tx.get("signature")
-    if not sig or sig in data.get("seen_tx", []):
+def incoming_lamports(detail):
+    """Yields the lamports of each transfer in a Solscan tx detail that lands on WALLET."""
+    for k in TRANSFER_KEYS:
+        for item in detail.get(k) or ():
+            to = item.get("to") or item.get("destination") or item.get("tokenAddress")
+            amt = item.get("amount") or item.get("lamports") or item.get("value")
+            if not (to and amt and to.lower() == WALLET_LC):
+                continue
+            try:
+                lamports = int(amt)
+            except Exception:
+                try:
+                    lamports = int(float(amt) * 1_000_000_000)
+                except Exception:
+                    continue
+            yield lamports
+
+def is_valid_detail(detail):
+    return bool(detail) and isinstance(detail, dict) and detail.get("status") != "error"
+
+def handle_new_payment(sig, detail, raw):
+    with data_lock.write():
+        if sig in seen_set:
+            return
+        remember_tx(sig)
+    # Cheap memo check first; the transfer scan stops as soon as the running total is enough.
+    if b"SLC30" not in raw:
         return
-    detail = get_tx_detail(sig)
-    data.setdefault("seen_tx", []).append(sig)
-    try:
-        lamports = 0
-        for k in ("nativeTransfers","solTransfers","transfers","tokenTransfers","sol_transfer"):
-            for item in (detail.get(k) or []):
-                to = item.get("to") or item.get("destination") or item.get("tokenAddress")
-                amt = item.get("amount") or item.get("lamports") or item.get("value")
-                if to and to.lower() == WALLET.lower() and amt:
-                    try:
-                        lamports += int(amt)
-                    except Exception:
-                        try:
-                            lamports += int(float(amt) * 1_000_000_000)
-                        except Exception:
-                            pass
-        memo_found = "SLC30" in json.dumps(detail)
-        if lamports >= MIN_LAMPORTS and memo_found:
-            signer = (detail.get("feePayer") or detail.get("signer") or
-                      (detail.get("transaction",{}) or {}).get("message",{}).get("accountKeys", [None])[0])
-            if signer:
-                username = data.get("wallet_map", {}).get(signer)
-                if username:
-                    grant_access_to(username, signer, sig)
-    finally:
-        save_data(data)
+    if not any(total >= MIN_LAMPORTS for total in accumulate(incoming_lamports(detail))):
+        return
+    signer = (detail.get("feePayer") or detail.get("signer") or
+              (detail.get("transaction",{}) or {}).get("message",{}).get("accountKeys", [None])[0])
+    if signer:
+        with data_lock.read():
+            username = data.get("wallet_map", {}).get(signer)
+        if username:
+            grant_access_to(username, signer, sig)
 
 def grant_access_to(username, wallet_addr, signature):
     uname = username if username.startswith("@") else ("@" + username) if username.isalnum() else username
-    u = data.setdefault("users", {}).setdefault(uname, {})
     now = datetime.utcnow().isoformat()
-    if "join" not in u:
-        u["join"] = now
-    u["last_paid"] = now
-    u["wallet"] = wallet_addr
+    with data_lock.write():
+        u = data.setdefault("users", {}).setdefault(uname, {})
+        if "join" not in u:
+            u["join"] = now
+        u["last_paid"] = now
+        u["wallet"] = wallet_addr
+        uid = u.get("user_id")
+    dirty.set()
     invite = export_invite_link(SLC_CHAT_ID)
     welcome = ("Welcome to the SLC Trench Scanner. This channel provides raw contract addresses scans from inside the SLC ecosystem in real-time. "
                "There is no delay, every CA inside the SLC will be immediately sent into here. You are only seeing the data, no theories, no due diligence, no inside info. "
                "There will be duplicates, there will be times of noise and times of silence. The alpha is there, the runner is there, it is up to you to find it. "
                "For full Discord access, inquire via DM at 431steez. Join the SLC, access the edge.")
-    uid = u.get("user_id")
     target = uid if uid else uname
     send_message(target, welcome)
     if invite:
         send_message(target, f"Join the private SLC Trench Scanner here: {invite}")
     print(f"[{datetime.utcnow().isoformat()}] Granted access to {uname} for payment {signature}")
-    save_data(data)
 
 def poll_telegram_updates():
     offset = None
     while True:
         try:
-            params = {"timeout":20, "limit":10}
+            params = {"timeout":TG_LONG_POLL, "limit":100}
             if offset: params["offset"] = offset
-            r = requests.get(f"{TELE_BASE}/getUpdates", params=params, timeout=25).json()
+            r = orjson.loads(SESSION.get(f"{TELE_BASE}/getUpdates", params=params, timeout=TG_LONG_POLL + 5).content)
             for upd in r.get("result", []):
                 offset = upd["update_id"] + 1
                 msg = upd.get("message") or upd.get("edited_message") or {}
@@ -162,21 +290,30 @@ def poll_telegram_updates():
                     parts = text.split()
                     if len(parts) >= 2:
                         w = parts[1].strip()
-                        data.setdefault("wallet_map", {})[w] = uname
-                        u = data.setdefault("users", {}).setdefault(uname, {})
-                        u.setdefault("join", datetime.utcnow().isoformat())
-                        u["user_id"] = uid
-                        u["wallet"] = w
-                        save_data(data)
+                        with data_lock.write():
+                            prev = data.setdefault("wallet_map", {}).get(w)
+                            if prev and prev != uname and w in data["user_wallets"].get(prev, ()):
+                                data["user_wallets"][prev].remove(w)
+                            data["wallet_map"][w] = uname
+                            ws = data["user_wallets"].setdefault(uname, [])
+                            if w not in ws:
+                                ws.append(w)
+                            u = data.setdefault("users", {}).setdefault(uname, {})
+                            u.setdefault("join", datetime.utcnow().isoformat())
+                            u["user_id"] = uid
+                            u["wallet"] = w
+                        dirty.set()
                         send_message(uid, f"Thanks {uname}. I mapped wallet `{w}` to your Telegram account. Now send payment of >=0.15 SOL with memo `SLC30` to {WALLET}.")
                     else:
-                        u = data.setdefault("users", {}).setdefault(uname, {})
-                        u.setdefault("join", datetime.utcnow().isoformat())
-                        u["user_id"] = uid
-                        save_data(data)
+                        with data_lock.write():
+                            u = data.setdefault("users", {}).setdefault(uname, {})
+                            u.setdefault("join", datetime.utcnow().isoformat())
+                            u["user_id"] = uid
+                        dirty.set()
                         send_message(uid, "Send `/start <your_solana_wallet_address>` so I can match your payment. Example: `/start DqTx...`")
                 elif text.lower().startswith("/myjoin"):
-                    info = data.get("users", {}).get(uname)
+                    with data_lock.read():
+                        info = dict(data.get("users", {}).get(uname) or {})
                     if not info:
                         send_message(uid, "No join record found. Use `/start <wallet>` first before paying.")
                     else:
@@ -192,53 +329,126 @@ def poll_telegram_updates():
             print("tg poll error", e)
             time.sleep(5)
 
+def is_expired(info, cutoff_iso):
+    # Only well-formed "YYYY-MM-DDTHH:MM:SS..." values compare correctly as strings;
+    # empty or malformed timestamps are skipped, as the old fromisoformat check did.
+    last = info.get("last_paid") or info.get("join")
+    return (isinstance(last, str) and len(last) >= 19 and last[4] == "-" and last[10] == "T"
+            and last < cutoff_iso)
+
+def kick_and_notify(uname, user_id, cutoff_iso):
+    # The user may have renewed since the sweep's snapshot; don't kick a paying member.
+    with data_lock.read():
+        info = data.get("users", {}).get(uname)
+        if not info or not is_expired(info, cutoff_iso):
+            return False
+    if not kick_from_chat(SLC_CHAT_ID, user_id):
+        print(f"Kick failed for {uname} ({user_id}); keeping record for the next sweep")
+        return False
+    send_message(user_id, "Your 30-day access expired and you have been removed from the SLC Trench Scanner. Re-pay to regain access.")
+    print(f"Kicked {uname} ({user_id}) due to expiry")
+    return True
+
+def run_expiry_sweep():
+    print(f"[{datetime.utcnow().isoformat()}] Running daily expiry sweep")
+    with data_lock.read():
+        users = [(uname, dict(info)) for uname, info in data.get("users", {}).items()]
+    # Timestamps are all datetime.utcnow().isoformat(), which sorts lexicographically,
+    # so a plain string compare against one cutoff replaces per-user parsing.
+    cutoff_iso = (datetime.utcnow() - timedelta(days=30)).isoformat()
+    expired = []
+    for uname, info in users:
+        if is_whitelisted(uname):
+            continue
+        if is_expired(info, cutoff_iso):
+            expired.append((uname, info.get("user_id")))
+    if not expired:
+        return
+    # Users we can't kick (no user_id) are just dropped; the rest only once the kick succeeded,
+    # so a failed kick is retried by the next sweep instead of leaving them in the chat forever.
+    removable = [uname for uname, user_id in expired if not user_id]
+    to_kick = [(uname, user_id) for uname, user_id in expired if user_id]
+    if to_kick:
+        with ThreadPoolExecutor(max_workers=min(len(to_kick), KICK_WORKERS)) as pool:
+            names, ids = zip(*to_kick)
+            kicked = list(pool.map(kick_and_notify, names, ids, repeat(cutoff_iso)))
+        removable += [uname for uname, ok in zip(names, kicked) if ok]
+    if not removable:
+        return
+    with data_lock.write():
+        wallet_map = data.get("wallet_map", {})
+        for uname in removable:
+            # Re-check: grant_access_to may have recorded a renewal while the kicks ran.
+            info = data["users"].get(uname)
+            if not info or not is_expired(info, cutoff_iso):
+                continue
+            data["users"].pop(uname, None)
+            for w in data["user_wallets"].pop(uname, ()):
+                if wallet_map.get(w) == uname:
+                    wallet_map.pop(w, None)
+    dirty.set()
+
 def daily_expiry_check():
     while True:
         now = datetime.utcnow()
         next_mid = (now + timedelta(days=1)).replace(hour=0, minute=0, second=10, microsecond=0)
-        time.sleep((next_mid - now).total_seconds())
-        print(f"[{datetime.utcnow().isoformat()}] Running daily expiry sweep")
-        changed = False
-        for uname, info in list(data.get("users", {}).items()):
-            if is_whitelisted(uname):
-                continue
-            last = info.get("last_paid") or info.get("join")
-            if not last: continue
-            try:
-                last_dt = datetime.fromisoformat(last)
-            except Exception:
-                continue
-            if datetime.utcnow() - last_dt > timedelta(days=30):
-                user_id = info.get("user_id")
-                if user_id:
-                    kick_from_chat(SLC_CHAT_ID, user_id)
-                    send_message(user_id, "Your 30-day access expired and you have been removed from the SLC Trench Scanner. Re-pay to regain access.")
-                    print(f"Kicked {uname} ({user_id}) due to expiry")
-                data["users"].pop(uname, None)
-                for w,a in list(data.get("wallet_map", {}).items()):
-                    if a == uname:
-                        data["wallet_map"].pop(w, None)
-                changed = True
-        if changed:
-            save_data(data)
+        # Sleep in bounded chunks and re-read the wall clock on every wake, so an early
+        # return or a clock adjustment can't make the sweep run at the wrong time.
+        while now < next_mid:
+            time.sleep(min((next_mid - now).total_seconds(), EXPIRY_RECHECK))
+            now = datetime.utcnow()
+        try:
+            run_expiry_sweep()
+        except Exception as e:
+            print("expiry sweep error", e)
 
 def solscan_loop():
+    # sig -> consecutive failed/malformed detail fetches. Failures are retried on later polls,
+    # but only DETAIL_MAX_ATTEMPTS times so a permanently bad signature stops costing a GET every poll.
+    detail_failures = {}
     while True:
         try:
-            txs = get_last_txs_for(WALLET, limit=50)
-            for tx in txs or []:
-                handle_new_payment(tx)
+            sigs = get_recent_signatures(WALLET, limit=50)
+            # Drop seen and repeated signatures before any detail fetch (order preserved).
+            new_sigs = list(dict.fromkeys(s for s in sigs if s and s not in seen_set))
+            for sig in [s for s in detail_failures if s not in new_sigs]:
+                detail_failures.pop(sig)
+            if new_sigs:
+                with ThreadPoolExecutor(max_workers=DETAIL_WORKERS) as pool:
+                    details = list(pool.map(get_tx_detail, new_sigs))
+                try:
+                    for sig, (detail, raw) in zip(new_sigs, details):
+                        if is_valid_detail(detail):
+                            detail_failures.pop(sig, None)
+                            handle_new_payment(sig, detail, raw)
+                            continue
+                        detail_failures[sig] = detail_failures.get(sig, 0) + 1
+                        if detail_failures[sig] >= DETAIL_MAX_ATTEMPTS:
+                            print(f"Giving up on tx {sig} after {DETAIL_MAX_ATTEMPTS} failed detail fetches")
+                            detail_failures.pop(sig)
+                            with data_lock.write():
+                                remember_tx(sig)
+                finally:
+                    dirty.set()   # one flush per batch persists the newly seen signatures
         except Exception as e:
             print("solscan poll error", e)
         time.sleep(30)
 
+def handle_sigterm(signum, frame):
+    # Render (and most supervisors) stop the service with SIGTERM; route it through the
+    # KeyboardInterrupt path so pending changes are flushed before exit.
+    raise KeyboardInterrupt
+
 if __name__ == "__main__":
     print("SLC Trench Scanner helper starting...")
+    signal.signal(signal.SIGTERM, handle_sigterm)
     save_data(data)
     threading.Thread(target=poll_telegram_updates, daemon=True).start()
     threading.Thread(target=daily_expiry_check, daemon=True).start()
+    threading.Thread(target=flush_loop, daemon=True).start()
     try:
         solscan_loop()
     except KeyboardInterrupt:
         print("Stopping...")
+        save_data(data)
 